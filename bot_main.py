@@ -0,0 +1,146 @@
+# bot_main.py — bot Telegram + health check HTTP chạy chung 1 event loop (không Flask, không thread phụ)
+import os, asyncio, logging, importlib.util
+try:
+    import fcntl  # POSIX; không có (Windows) thì bỏ qua khoá
+except ImportError:
+    fcntl = None
+try:
+    import uvloop  # event loop libuv (C): socket I/O + timer nhanh hơn loop mặc định; không có (Windows) thì thôi
+except ImportError:
+    uvloop = None
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
+from main import (
+    db_init, db_purge_expired, post_init, post_shutdown,
+    handle_spx_text, handle_cookie_text, handle_input_text, _SPX_RE, _COOKIE_ROUTE_RE, _loads,
+    start, help_command, balance, buy, confirm, list_cmd
+)
+
+logger = logging.getLogger("bot_main")  # cấu hình logging (root WARNING) nằm ở main
+logger.setLevel(logging.INFO)
+
+# Chỉ nhận loại update handler thực sự xử lý: handler trả lời qua update.message (None với edited_message)
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# vd. http://127.0.0.1:8081 (Bot API server tự host); để trống = api.telegram.org
+BOT_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+
+BOT_LOCK_PATH = os.getenv("BOT_LOCK_PATH", "/tmp/bot-spx.lock")
+_bot_lock_fd = None  # giữ fd mở suốt đời process => giữ khoá; process chết thì kernel tự nhả
+
+def _acquire_bot_lock():
+    """Chặn tới khi lấy được flock: mỗi lúc chỉ 1 process gọi getUpdates (Telegram chỉ cho 1 consumer)."""
+    global _bot_lock_fd
+    if fcntl is None: return
+    _bot_lock_fd = open(BOT_LOCK_PATH, "a")
+    try:
+        fcntl.flock(_bot_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info("Bot đang chạy ở process khác; chờ tiếp quản nếu process đó dừng…")
+        fcntl.flock(_bot_lock_fd, fcntl.LOCK_EX)
+
+# Health check cho platform: trả 200 cho mọi path, dựng sẵn bytes, đóng kết nối ngay
+_HEALTH_RESP = (
+    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 3\r\n"
+    b"Cache-Control: no-store\r\nConnection: close\r\n\r\nok\n"
+)
+_health_server: asyncio.Server | None = None
+
+async def _health(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        writer.write(_HEALTH_RESP)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def _post_init(application: Application):
+    global _health_server
+    await post_init(application)
+    port = os.getenv("PORT")
+    if port:  # web service (Render/Heroku) cần bind PORT; chạy như worker thì bỏ qua
+        _health_server = await asyncio.start_server(_health, "0.0.0.0", int(port))
+        logger.info(f"Health check listening on :{port}")
+    # Khởi tạo/migrate + dọn DB trong executor: health check vẫn trả lời trong lúc chờ (polling bắt đầu sau post_init)
+    await asyncio.to_thread(db_init)
+    await asyncio.to_thread(db_purge_expired)
+
+async def _post_shutdown(application: Application):
+    if _health_server is not None:
+        _health_server.close()
+        await _health_server.wait_closed()
+    await post_shutdown(application)
+
+class _FastJSONRequest(HTTPXRequest):
+    """HTTPXRequest parse response Telegram bằng _loads (orjson nếu có) thẳng từ bytes, không decode str trước."""
+    __slots__ = ()
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return _loads(payload)
+        except ValueError:
+            # UTF-8 hỏng / JSON lỗi: để PTB tự xử (decode errors="replace", log + TelegramError)
+            return HTTPXRequest.parse_json_payload(payload)
+
+# /lệnh -> handler: 1 MessageHandler(filters.COMMAND) + 1 lần tra dict thay cho chuỗi CommandHandler
+COMMANDS = {
+    "start": start, "help": help_command, "balance": balance,
+    "buy": buy, "confirm": confirm, "list": list_cmd,
+}
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    # Tên lệnh lấy theo span của entity bot_command như CommandHandler ("/list," -> "list")
+    cmd, _, target = msg.text[1:msg.entities[0].length].partition("@")
+    if target and target.lower() != (context.bot.username or "").lower():
+        return  # /lệnh@bot_khác trong group: bỏ qua như CommandHandler
+    handler = COMMANDS.get(cmd.lower())
+    if handler is not None:
+        await handler(update, context)
+
+def build_application(token: str) -> Application:
+    # 1 client HTTPX dùng chung cho getUpdates + sendMessage: HTTP/2 (khi có h2) dồn mọi call vào 1 kết nối TLS;
+    # pool 32 để long-poll đang treo không chặn các reply song song. read timeout của getUpdates đã được PTB cộng thêm timeout
+    req = _FastJSONRequest(
+        connection_pool_size=32,
+        http_version="2" if importlib.util.find_spec("h2") else "1.1",
+        pool_timeout=5.0,
+    )
+    builder = Application.builder().token(token).request(req).get_updates_request(req)
+    if BOT_API_URL:  # telegram-bot-api --local chạy sidecar: gọi qua loopback thay vì api.telegram.org
+        builder = (builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+                   .local_mode(True))
+    application = builder.post_init(_post_init).post_shutdown(_post_shutdown).build()
+    application.add_handler(MessageHandler(filters.COMMAND, dispatch_command))
+    # Text thường: handler đầu tiên match thắng => SPX trước cookie, còn lại vào fallback
+    text = filters.TEXT & ~filters.COMMAND
+    application.add_handler(MessageHandler(text & filters.Regex(_SPX_RE), handle_spx_text))
+    application.add_handler(MessageHandler(text & filters.Regex(_COOKIE_ROUTE_RE), handle_cookie_text))
+    application.add_handler(MessageHandler(text, handle_input_text))
+    return application
+
+def main():
+    token = os.getenv("TELEGRAM_TOKEN")
+    if not token:
+        raise RuntimeError("Missing TELEGRAM_TOKEN")
+    _acquire_bot_lock()
+
+    # run_polling không tự tạo loop: nó dùng get_event_loop() (Python 3.14 báo lỗi nếu main thread chưa có loop)
+    # rồi tự đóng khi dừng (close_loop=True) => tạo sẵn đúng 1 loop ở đây, không rò
+    asyncio.set_event_loop(uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop())
+    application = build_application(token)
+    logger.info("Starting Telegram polling (will delete webhook if set)…")
+    # Chạy ở main thread: run_polling tự quản event loop, SIGINT/SIGTERM và post_init/post_shutdown
+    application.run_polling(
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=True,   # xoá webhook & backlog phía Telegram
+        poll_interval=0.0,           # long-poll: Telegram giữ kết nối tới khi có update
+        timeout=25,                  # PTB tự cộng vào read timeout của getUpdates (5s + 25s)
+    )
+
+if __name__ == "__main__":
+    main()
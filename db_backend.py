@@ -1,5 +1,17 @@
 # db_backend.py
-import os, json, time
+import os, time, queue, threading
+from contextlib import contextmanager
+
+# JSON lưu dạng BLOB (bytes UTF-8) => khỏi decode/encode str thừa; _loads nhận cả bytes lẫn str
+# nên các row TEXT cũ vẫn đọc được
+try:
+    import orjson
+    _dumps = lambda o: orjson.dumps(o, option=orjson.OPT_NON_STR_KEYS)  # key int như json chuẩn
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _dumps = lambda o: json.dumps(o, ensure_ascii=False).encode()
+    _loads = json.loads
 
 CACHE_TTL = 3 * 24 * 3600  # 3 ngày
 USE_TURSO = bool(os.getenv("LIBSQL_URL"))
@@ -8,6 +20,46 @@ if not USE_TURSO:
     import sqlite3
     DB_PATH = os.path.join(os.getcwd(), "data", "orders.db")
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    # Pool connection (autocommit) dùng chung mọi thread (executor DB, cache_writer): tối đa POOL_SIZE
+    # connection, mở dần khi cần và không đóng => giữ page cache. LIFO: connection vừa trả (cache nóng) được
+    # dùng lại trước; hết slot thì chờ. WAL cho phép đọc và ghi chạy song song
+    POOL_SIZE = max(8, 2 * (os.cpu_count() or 1))
+    _POOL: queue.LifoQueue = queue.LifoQueue()
+    _pool_lock = threading.Lock()
+    _pool_opened = 0
+
+    def _connect():
+        con = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+        # PRAGMA theo connection: giảm fsync, page cache ~20MB, mmap 128MB
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA cache_size=-20000")
+        con.execute("PRAGMA mmap_size=134217728")
+        con.execute("PRAGMA busy_timeout=10000")
+        return con
+
+    @contextmanager
+    def _get_conn():
+        """Mượn 1 connection của pool trong khối with (cả transaction), xong trả lại."""
+        global _pool_opened
+        try:
+            con = _POOL.get_nowait()
+        except queue.Empty:
+            with _pool_lock:
+                grow = _pool_opened < POOL_SIZE
+                if grow: _pool_opened += 1
+            if grow:
+                try:
+                    con = _connect()
+                except Exception:
+                    with _pool_lock: _pool_opened -= 1
+                    raise
+            else:
+                con = _POOL.get()
+        try:
+            yield con
+        finally:
+            _POOL.put(con)
 else:
     # ⚠️ Dùng client ĐỒNG BỘ
     from libsql_client import create_client_sync
@@ -29,65 +81,168 @@ def _now() -> int:
     return int(time.time())
 
 
-def db_init():
+# Schema 2 bảng: payload (items/meta) lưu 1 lần trong product_blobs, oid và tracking_number
+# chỉ là 2 dòng key -> blob_id trong cache_keys (WITHOUT ROWID: insert không đổi last_insert_rowid).
+# AUTOINCREMENT: blob_id đã xoá không bao giờ được cấp lại => key sót lại không thể trỏ nhầm sang payload mới
+_BLOBS_DDL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        blob_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        items_json BLOB NOT NULL,
+        meta_json  BLOB,
+        first_name TEXT,
+        ts INTEGER NOT NULL
+    )
+"""
+_SCHEMA = (
+    _BLOBS_DDL.format(name="product_blobs"),
+    """
+    CREATE TABLE IF NOT EXISTS cache_keys (
+        cache_key TEXT PRIMARY KEY,
+        blob_id INTEGER NOT NULL REFERENCES product_blobs(blob_id)
+    ) WITHOUT ROWID
+    """,
+    # idx_blobs_ts: /list đi ngược theo ts rồi dừng ở LIMIT, db_purge_expired lọc theo ts
+    # idx_keys_blob: join blob -> key (covering) và dọn key mồ côi
+    # idx_keys_spx: partial, chỉ chứa key SPXVN => join của /list chỉ dò các key SPX (WHERE phải khớp y hệt)
+    "CREATE INDEX IF NOT EXISTS idx_blobs_ts ON product_blobs(ts)",
+    "CREATE INDEX IF NOT EXISTS idx_keys_blob ON cache_keys(blob_id)",
+    "CREATE INDEX IF NOT EXISTS idx_keys_spx ON cache_keys(blob_id, cache_key) WHERE cache_key LIKE 'SPXVN%'",
+)
+
+
+def _first_name(items: list):
+    return (items[0] or {}).get("name") if items else None
+
+
+def _query(sql: str, args: tuple = ()) -> list:
+    """Chạy 1 câu lệnh, trả list row (Turso ↔︎ SQLite); tham số vị trí."""
     if USE_TURSO:
-        _get_client().execute("""
-        CREATE TABLE IF NOT EXISTS product_cache (
-            cache_key TEXT PRIMARY KEY,
-            items_json TEXT NOT NULL,
-            meta_json  TEXT,
-            ts INTEGER NOT NULL
-        )
-        """)
-    else:
-        con = sqlite3.connect(DB_PATH)
-        try:
-            con.execute("""
-            CREATE TABLE IF NOT EXISTS product_cache (
-                cache_key TEXT PRIMARY KEY,
-                items_json TEXT NOT NULL,
-                meta_json  TEXT,
-                ts INTEGER NOT NULL
-            )
-            """)
-            try:
-                con.execute("ALTER TABLE product_cache ADD COLUMN meta_json TEXT")
-            except Exception:
-                pass
-            con.commit()
-        finally:
-            con.close()
+        return list(_get_client().execute(sql, list(args)).rows)
+    with _get_conn() as con:
+        return con.execute(sql, args).fetchall()
 
 
-def db_upsert(cache_key: str, items: list, ts: int | None = None, meta: dict | None = None):
-    if not cache_key or not items:
+def _tx(stmts: list[tuple[str, tuple]], begin: str = "BEGIN"):
+    """Nhiều câu lệnh trong 1 transaction: 1 batch (Turso) / BEGIN…COMMIT (SQLite)."""
+    if not stmts:
         return
-    ts = ts or _now()
-    meta_json = json.dumps(meta or {}, ensure_ascii=False)
-    items_json = json.dumps(items, ensure_ascii=False)
-
     if USE_TURSO:
-        _get_client().execute(
-            "INSERT INTO product_cache(cache_key,items_json,meta_json,ts) "
-            "VALUES(:k,:i,:m,:t) "
-            "ON CONFLICT(cache_key) DO UPDATE "
-            "SET items_json=:i, meta_json=:m, ts=:t",
-            {"k": cache_key, "i": items_json, "m": meta_json, "t": ts}
-        )
-    else:
-        import sqlite3
-        con = sqlite3.connect(DB_PATH)
+        from libsql_client import Statement
+        _get_client().batch([Statement(sql, list(args)) for sql, args in stmts])
+        return
+    with _get_conn() as con:
+        con.execute(begin)
         try:
-            con.execute(
-                "INSERT INTO product_cache(cache_key,items_json,meta_json,ts) "
-                "VALUES(?,?,?,?) "
-                "ON CONFLICT(cache_key) DO UPDATE "
-                "SET items_json=excluded.items_json, meta_json=excluded.meta_json, ts=excluded.ts",
-                (cache_key, items_json, meta_json, ts)
-            )
-            con.commit()
-        finally:
-            con.close()
+            for sql, args in stmts:
+                con.execute(sql, args)
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+
+# PRAGMA user_version: 0 = DB mới hoặc còn bảng product_cache cũ, 2 = product_blobs + cache_keys,
+# 3 = thêm idx_keys_spx, 4 = product_blobs.blob_id AUTOINCREMENT
+SCHEMA_VERSION = 4
+
+
+def _rebuild_blobs_autoincrement() -> list:
+    """Câu lệnh dựng lại product_blobs (tạo trước khi có AUTOINCREMENT) giữ nguyên blob_id, bỏ key mồ côi."""
+    rows = _query("SELECT sql FROM sqlite_master WHERE type='table' AND name='product_blobs'")
+    if not rows or "AUTOINCREMENT" in (rows[0][0] or "").upper():
+        return []
+    return [
+        (_BLOBS_DDL.format(name="product_blobs_v4"), ()),
+        ("INSERT INTO product_blobs_v4(blob_id, items_json, meta_json, first_name, ts) "
+         "SELECT blob_id, items_json, meta_json, first_name, ts FROM product_blobs", ()),
+        ("DROP TABLE product_blobs", ()),
+        ("ALTER TABLE product_blobs_v4 RENAME TO product_blobs", ()),
+        ("CREATE INDEX IF NOT EXISTS idx_blobs_ts ON product_blobs(ts)", ()),
+        ("DELETE FROM cache_keys WHERE blob_id NOT IN (SELECT blob_id FROM product_blobs)", ()),
+    ]
+
+
+def _migrate_product_cache() -> list:
+    """Câu lệnh chuyển bảng 1-key-1-row cũ (product_cache) sang product_blobs + cache_keys rồi DROP."""
+    tables = {r[0] for r in _query("SELECT name FROM sqlite_master WHERE type='table'")}
+    if "product_cache" not in tables:
+        return []
+    cols = {r[1] for r in _query("PRAGMA table_info(product_cache)")}
+    meta = "meta_json" if "meta_json" in cols else "NULL"
+    name = "first_name" if "first_name" in cols else "NULL"
+    return [
+        ("INSERT INTO product_blobs(blob_id, items_json, meta_json, first_name, ts) "
+         f"SELECT rowid, items_json, {meta}, {name}, ts FROM product_cache", ()),
+        ("INSERT OR REPLACE INTO cache_keys(cache_key, blob_id) "
+         "SELECT cache_key, rowid FROM product_cache", ()),
+        ("DROP TABLE product_cache", ()),
+    ]
+
+
+def db_init():
+    if not USE_TURSO:
+        # WAL lưu luôn trong file DB; các PRAGMA còn lại set ở _get_conn. Turso không áp dụng
+        _query("PRAGMA journal_mode=WAL")
+    # Schema đã đúng phiên bản => không đụng tới schema (không CREATE/ALTER mỗi lần khởi động)
+    if int(_query("PRAGMA user_version")[0][0]) >= SCHEMA_VERSION:
+        return
+    # CREATE + migrate + đặt version trong 1 transaction EXCLUSIVE: process khác khởi động song song phải chờ
+    _tx(
+        [(sql, ()) for sql in _SCHEMA] + _rebuild_blobs_autoincrement() + _migrate_product_cache()
+        + [(f"PRAGMA user_version = {SCHEMA_VERSION}", ())],
+        begin="BEGIN EXCLUSIVE",
+    )
+
+
+def _upsert_stmts(keys: tuple, items_blob: bytes, meta_blob: bytes, first_name, ts: int) -> list:
+    ph = ",".join("?" * len(keys))
+    return [
+        # Chỉ xoá blob cũ không còn key nào NGOÀI `keys` trỏ tới (idx_keys_blob). Blob dùng chung với order
+        # khác (vd. chung mã SPX của đơn gộp) giữ nguyên; key ngoài `keys` không bao giờ bị xoá ở đây.
+        # AUTOINCREMENT => tracking_number cũ còn sót chỉ giữ payload cũ của nó, không trỏ nhầm sang blob mới
+        (f"DELETE FROM product_blobs WHERE blob_id IN (SELECT blob_id FROM cache_keys WHERE cache_key IN ({ph})) "
+         "AND NOT EXISTS (SELECT 1 FROM cache_keys c WHERE c.blob_id = product_blobs.blob_id "
+         f"AND c.cache_key NOT IN ({ph}))", (*keys, *keys)),
+        ("INSERT INTO product_blobs(items_json, meta_json, first_name, ts) VALUES(?,?,?,?)",
+         (items_blob, meta_blob, first_name, ts)),
+        *(
+            ("INSERT INTO cache_keys(cache_key, blob_id) VALUES(?, last_insert_rowid()) "
+             "ON CONFLICT(cache_key) DO UPDATE SET blob_id=excluded.blob_id", (k,))
+            for k in keys
+        ),
+    ]
+
+
+def db_upsert(cache_key: str, items: list, ts: int | None = None, meta: dict | None = None):
+    db_upsert_many([((cache_key,), items, meta, ts)])
+
+
+def _touch_stmt(keys: tuple, ts: int) -> tuple:
+    ph = ",".join("?" * len(keys))
+    return (f"UPDATE product_blobs SET ts = ? WHERE blob_id IN (SELECT blob_id FROM cache_keys WHERE cache_key IN ({ph}))",
+            (ts, *keys))
+
+
+def db_upsert_many(rows: list[tuple]):
+    """Ghi nhiều (keys, items, meta, ts) trong 1 transaction (SQLite) / 1 batch (Turso).
+    Mỗi row encode + lưu payload 1 lần, mọi key trong `keys` cùng trỏ tới nó.
+    items=None: payload không đổi, chỉ làm mới ts (không encode, không ghi lại blob)."""
+    now = _now()
+    stmts = []
+    for keys, items, meta, ts in rows:
+        keys = tuple(k for k in keys if k)
+        if not keys:
+            continue
+        if items is None:
+            stmts.append(_touch_stmt(keys, ts or now))
+        elif items:
+            stmts += _upsert_stmts(keys, _dumps(items), _dumps(meta or {}), _first_name(items), ts or now)
+    _tx(stmts)
+
+
+_SELECT_BY_KEY = (
+    "FROM cache_keys k JOIN product_blobs b ON b.blob_id = k.blob_id WHERE k.cache_key = ?"
+)
 
 
 def db_get(cache_key: str):
@@ -96,88 +251,65 @@ def db_get(cache_key: str):
         return None, None
 
     cutoff = _now() - CACHE_TTL
-
-    if USE_TURSO:
-        rs = _get_client().execute(
-            "SELECT items_json, meta_json, ts FROM product_cache WHERE cache_key = :k",
-            {"k": cache_key}
-        )
-        row = rs.rows[0] if rs.rows else None
-        if not row:
-            return None, None
-
-        items_json, meta_json, ts = row[0], row[1], int(row[2])
-        if ts < cutoff:
-            _get_client().execute("DELETE FROM product_cache WHERE cache_key = :k", {"k": cache_key})
-            return None, None
-        return (
-            json.loads(items_json) if items_json else None,
-            json.loads(meta_json) if meta_json else None
-        )
-
-    else:
-        import sqlite3
-        con = sqlite3.connect(DB_PATH)
+    rows = _query(f"SELECT b.items_json, b.meta_json, b.ts {_SELECT_BY_KEY}", (cache_key,))
+    if not rows:
+        return None, None
+    items_json, meta_json, ts = rows[0][0], rows[0][1], int(rows[0][2])
+    if ts < cutoff:
         try:
-            cur = con.execute(
-                "SELECT items_json, meta_json, ts FROM product_cache WHERE cache_key=?",
-                (cache_key,)
-            )
-            row = cur.fetchone()
-            if not row:
-                return None, None
-            items_json, meta_json, ts = row
-            if _now() - int(ts) > CACHE_TTL:
-                try:
-                    con.execute("DELETE FROM product_cache WHERE cache_key=?", (cache_key,))
-                    con.commit()
-                except Exception:
-                    pass
-                return None, None
-            return (
-                json.loads(items_json) if items_json else None,
-                json.loads(meta_json) if meta_json else None
-            )
-        finally:
-            con.close()
+            _query("DELETE FROM cache_keys WHERE cache_key = ?", (cache_key,))
+        except Exception:
+            pass
+        return None, None
+    return (
+        _loads(items_json) if items_json else None,
+        _loads(meta_json) if meta_json else None
+    )
+
+
+def db_get_items(cache_key: str):
+    """Như db_get nhưng chỉ đọc + decode items. Trả (items, ts) hoặc (None, None)."""
+    if not cache_key:
+        return None, None
+
+    cutoff = _now() - CACHE_TTL
+    rows = _query(f"SELECT b.items_json, b.ts {_SELECT_BY_KEY} AND b.ts >= ?", (cache_key, cutoff))
+    if not rows or not rows[0][0]:
+        return None, None
+    return _loads(rows[0][0]), int(rows[0][1])
+
+
+_SELECT_SPX = (
+    "FROM product_blobs b JOIN cache_keys k ON k.blob_id = b.blob_id "
+    "WHERE k.cache_key LIKE 'SPXVN%' AND b.ts >= ? "
+    "ORDER BY b.ts DESC LIMIT ?"
+)
 
 
 def db_list_spx_keys(limit: int = 50):
     cutoff = _now() - CACHE_TTL
+    return [r[0] for r in _query(f"SELECT k.cache_key {_SELECT_SPX}", (cutoff, limit))]
 
-    if USE_TURSO:
-        rs = _get_client().execute(
-            "SELECT cache_key FROM product_cache "
-            "WHERE cache_key LIKE 'SPXVN%' AND ts >= :cut "
-            "ORDER BY ts DESC LIMIT :lim",
-            {"cut": cutoff, "lim": limit}
-        )
-        return [r[0] for r in rs.rows]
-    else:
-        import sqlite3
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT cache_key FROM product_cache "
-                "WHERE cache_key LIKE 'SPXVN%' AND ts >= ? "
-                "ORDER BY ts DESC LIMIT ?",
-                (cutoff, limit)
-            )
-            return [r[0] for r in cur.fetchall()]
-        finally:
-            con.close()
+
+def db_list_spx_with_summary(limit: int = 50):
+    """Mọi thứ /list cần trong 1 SELECT: [(cache_key, first_name, meta, ts)].
+    items_json chỉ được decode với row cũ chưa có first_name."""
+    cutoff = _now() - CACHE_TTL
+    rows = _query(
+        "SELECT k.cache_key, b.first_name, b.meta_json, b.ts, "
+        f"CASE WHEN b.first_name IS NULL THEN b.items_json END {_SELECT_SPX}",
+        (cutoff, limit)
+    )
+    return [
+        (k, name or (_first_name(_loads(items_json)) if items_json else None),
+         _loads(meta_json) if meta_json else {}, int(ts))
+        for k, name, meta_json, ts, items_json in rows
+    ]
 
 
 def db_purge_expired():
     cutoff = _now() - CACHE_TTL
-
-    if USE_TURSO:
-        _get_client().execute("DELETE FROM product_cache WHERE ts < :cut", {"cut": cutoff})
-    else:
-        import sqlite3
-        con = sqlite3.connect(DB_PATH)
-        try:
-            con.execute("DELETE FROM product_cache WHERE ts < ?", (cutoff,))
-            con.commit()
-        finally:
-            con.close()
+    _tx([
+        ("DELETE FROM product_blobs WHERE ts < ?", (cutoff,)),
+        ("DELETE FROM cache_keys WHERE blob_id NOT IN (SELECT blob_id FROM product_blobs)", ()),
+    ])
@@ -1,24 +1,83 @@
 # main.py
-import logging, json, os, requests, re
-from time import time
+import logging, os, re, queue, threading, asyncio, heapq, importlib.util
+import httpx
+from time import time, monotonic
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from telegram import ReplyKeyboardMarkup, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
+try:
+    from orjson import loads as _loads  # parse thẳng từ bytes
+except ImportError:
+    from json import loads as _loads
+
+try:
+    import simdjson  # on-demand: chỉ materialize field cần dùng
+except ImportError:
+    simdjson = None
+
 # ===== DB backend (Turso ↔︎ SQLite) =====
-from db_backend import db_init, db_upsert, db_get, db_list_spx_keys, db_purge_expired, CACHE_TTL
+from db_backend import db_init, db_upsert_many, db_get, db_get_items, db_list_spx_with_summary, db_purge_expired, CACHE_TTL
 
 # ===== Logging =====
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Root ở WARNING: httpx/PTB không log INFO cho mỗi getUpdates/API call; logger của app vẫn ở INFO
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+for _name in ("httpx", "telegram.Bot", "telegram.ext.Application", "telegram.ext.Updater"):
+    logging.getLogger(_name).setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 # ===== Constants =====
 API_URL = "https://us-central1-get-feedback-a0119.cloudfunctions.net/app/api/shopee/getOrderDetailsForCookie"
 SPX_API_URL = "https://spx.vn/shipment/order/open/order/get_order_info"
 VN_TZ = timezone(timedelta(hours=7))
-
-# Cache RAM: key -> {"items":[...], "meta": {...}, "ts": int}
-PRODUCT_CACHE: dict[str, dict] = {}
+_SPX_RE = re.compile(r"\bSPXVN[A-Z0-9]{8,}\b", re.IGNORECASE)
+# Lọc cookie rác trước khi tốn 1 lần gọi API (timeout 10s)
+_COOKIE_RE = re.compile(r"^SPC|[;=]")
+# Route tin nhắn sang handle_cookie_text: có ';' hoặc (sau khoảng trắng đầu) bắt đầu bằng SPC
+_COOKIE_ROUTE_RE = re.compile(r"^\s*SPC|;")
+_CTRL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+COOKIE_MAX_LEN = 8192
+_WS_RE = re.compile(r"\s+")  # gộp khoảng trắng trong địa chỉ (1 lượt, không tạo list như split/join)
+
+# HTTP async + keep-alive: không chặn event loop của PTB, giữ kết nối TLS tới Shopee API / SPX.
+# retries=2 chỉ retry lỗi kết nối (không gửi lặp POST đã tới server); HTTP/2 khi có gói h2
+# Retry theo status 502/503/504 chỉ làm ở call_spx_api (GET idempotent), như Retry(total=2, backoff_factor=0.3) cũ
+SPX_RETRY_STATUS = frozenset((502, 503, 504))
+SPX_RETRIES, SPX_BACKOFF_S = 2, 0.3
+_HTTP2 = importlib.util.find_spec("h2") is not None
+# httpx chỉ giải nén br khi có brotli/brotlicffi => chỉ xin br khi decode được
+_BROTLI = any(importlib.util.find_spec(m) for m in ("brotli", "brotlicffi"))
+_HTTPX = httpx.AsyncClient(
+    timeout=10.0,
+    transport=httpx.AsyncHTTPTransport(
+        http2=_HTTP2, retries=2,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    ),
+    headers={  # json= tự set Content-Type cho POST
+        "User-Agent": "bot-spx/1.0",
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, br" if _BROTLI else "gzip",
+    },
+)
+
+# Cache RAM (LRU có giới hạn): key -> _Entry; oid và tracking_number trỏ chung 1 _Entry
+class _Entry:
+    __slots__ = ("items", "meta", "ts", "fp")  # không có __dict__: ~1/4 RAM của dict, đọc e.ts nhanh hơn e["ts"]
+
+    def __init__(self, items: list, meta: dict, ts: int, fp: int | None = None):
+        self.items, self.meta, self.ts, self.fp = items, meta, ts, fp
+
+PRODUCT_CACHE: OrderedDict[str, _Entry] = OrderedDict()
+RAM_MAX_ENTRIES = 10_000
+RAM_EVICT_EVERY_S = 300
+DB_PURGE_EVERY_S = 600  # xoá row DB hết hạn định kỳ (thay vì mỗi lần tra cookie)
+DB_WORKERS = 16  # default executor cho asyncio.to_thread (đọc SQLite/Turso)
+TN_PLACEHOLDERS = frozenset(("Đang chờ",))  # tracking_number Shopee trả khi đơn chưa có mã vận đơn
+LIST_PAGE_CHARS = 3800  # < 4096 (giới hạn 1 tin nhắn Telegram)
 
 # ===== UI helpers =====
 def build_menu():
@@ -31,45 +90,184 @@ def build_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@lru_cache(maxsize=2048)
+def _fmt_vnd_int(n: int) -> str:
+    return f"{n:,}".replace(",", ".") + "đ"
+
 def vnd(n: int | float) -> str:
-    try: return f"{int(n):,}".replace(",", ".") + "đ"
+    try: return _fmt_vnd_int(int(n))
     except: return f"{n}đ"
 
+def _normalize_price(raw) -> int:
+    """order_price của Shopee có lúc ×100000, lúc ×100, lúc là đ."""
+    if not isinstance(raw, (int, float)): return 0
+    raw = int(raw)  # float (hiếm) -> int 1 lần: phép // phía sau luôn là int, không cần int() ở chỗ gọi
+    return raw//100_000 if raw>1_000_000_000 else (raw//100 if raw>10_000 else raw)
+
+# Epoch đã cộng sẵn +7h: ts -> giờ VN chỉ còn 1 phép cộng timedelta, không cần tzinfo/strftime
+_VN_EPOCH = datetime(1970, 1, 1) + VN_TZ.utcoffset(None)
+
 def ts_to_vn(ts: int | float) -> str:
-    try: return datetime.fromtimestamp(int(ts), VN_TZ).strftime("%H:%M:%S • %d/%m/%Y")
+    try:
+        d = _VN_EPOCH + timedelta(seconds=int(ts))
+        return f"{d.hour:02d}:{d.minute:02d}:{d.second:02d} • {d.day:02d}/{d.month:02d}/{d.year}"
     except: return str(ts)
 
 def short_addr(address_text: str, max_len: int = 90) -> str:
     if not address_text: return ""
-    s = " ".join(address_text.split())
+    s = _WS_RE.sub(" ", address_text).strip()
     return s if len(s) <= max_len else s[:max_len-1] + "…"
 
+def _body_head(r: httpx.Response, n: int = 200) -> str:
+    """n byte đầu của body để log: cắt bytes trước rồi mới decode, không decode cả body như r.text."""
+    return r.content[:n].decode("utf-8", "replace")
+
 # ===== Cache orchestration (RAM + DB) =====
-def cache_store_from_order(order: dict):
+# Ghi DB chạy nền: handler chỉ cập nhật RAM rồi đẩy row (keys, items, meta, ts) vào queue (items=None: chỉ làm mới ts)
+_write_q: queue.SimpleQueue = queue.SimpleQueue()
+WRITE_BATCH, WRITE_FLUSH_S = 64, 0.1
+WRITER_JOIN_S = 10.0  # post_shutdown chờ thread ghi flush xong tối đa chừng này
+_WRITE_STOP = object()  # sentinel: ghi nốt batch đang gom rồi thoát
+_writer_thread: threading.Thread | None = None
+
+def _writer():
+    stop = False
+    while not stop:
+        batch = [_write_q.get()]
+        deadline = monotonic() + WRITE_FLUSH_S
+        while len(batch) < WRITE_BATCH:
+            left = deadline - monotonic()
+            if left <= 0: break
+            try: batch.append(_write_q.get(timeout=left))
+            except queue.Empty: break
+        if _WRITE_STOP in batch:
+            stop = True
+            batch = [r for r in batch if r is not _WRITE_STOP]
+        if not batch: continue
+        try: db_upsert_many(batch)
+        except Exception as err:
+            logger.warning(f"cache write error: {err}")
+            _forget_fp(batch)
+
+def _forget_fp(batch: list):
+    """Batch ghi hỏng (DB locked, Turso lỗi mạng): bỏ fp của entry RAM để lần gửi sau ghi lại đủ order,
+    thay vì chỉ làm mới ts của row chưa từng xuống DB. Gán 1 slot là atomic nên gọi từ thread ghi được"""
+    for keys, *_ in batch:
+        for k in keys:
+            e = PRODUCT_CACHE.get(k)
+            if e is not None: e.fp = None
+
+def _ram_set(key: str, entry: _Entry):
+    PRODUCT_CACHE[key] = entry
+    PRODUCT_CACHE.move_to_end(key)
+    while len(PRODUCT_CACHE) > RAM_MAX_ENTRIES:
+        PRODUCT_CACHE.popitem(last=False)
+
+def _ram_get(key: str, now: int | None = None):
+    """LRU + TTL: entry quá CACHE_TTL bị bỏ ngay khi đọc (không đợi _evict_loop)."""
+    e = PRODUCT_CACHE.get(key)
+    if e is None: return None
+    if (now or int(time())) - e.ts > CACHE_TTL:
+        PRODUCT_CACHE.pop(key, None)
+        return None
+    PRODUCT_CACHE.move_to_end(key)
+    return e
+
+def _ram_evict_expired(now: int | None = None):
+    cutoff = (now or int(time())) - CACHE_TTL
+    for k in [k for k, v in PRODUCT_CACHE.items() if v.ts < cutoff]:
+        PRODUCT_CACHE.pop(k, None)
+
+async def _evict_loop():
+    while True:
+        await asyncio.sleep(RAM_EVICT_EVERY_S)
+        try: _ram_evict_expired()
+        except Exception as err: logger.warning(f"evict error: {err}")
+
+async def _purge_loop():
+    while True:
+        await asyncio.sleep(DB_PURGE_EVERY_S)
+        try: await asyncio.to_thread(db_purge_expired)
+        except Exception as err: logger.warning(f"purge error: {err}")
+
+_bg_tasks: set[asyncio.Task] = set()
+
+async def post_init(application: Application):
+    """Hook Application.post_init: executor cho DB, thread ghi cache + dọn RAM/DB hết hạn định kỳ."""
+    # Start ở đây chứ không lúc import: chỉ process chạy bot mới cần thread ghi
+    global _writer_thread
+    _writer_thread = threading.Thread(target=_writer, daemon=True, name="cache_writer")
+    _writer_thread.start()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db"))
+    for coro, name in ((_evict_loop(), "ram_evict"), (_purge_loop(), "db_purge")):
+        task = asyncio.create_task(coro, name=name)
+        _bg_tasks.add(task)
+        task.add_done_callback(_bg_tasks.discard)
+
+async def post_shutdown(application: Application):
+    """Hook Application.post_shutdown: dừng task nền, ghi nốt queue cache xuống DB, đóng pool HTTP."""
+    # run_polling đóng loop ngay sau hook này => cancel + await, không để "Task was destroyed but it is pending"
+    tasks = list(_bg_tasks)
+    for task in tasks: task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _write_q.put(_WRITE_STOP)  # FIFO: mọi row đã put trước sentinel đều được ghi
+        await asyncio.to_thread(_writer_thread.join, WRITER_JOIN_S)
+        if _writer_thread.is_alive():
+            logger.warning(f"cache writer chưa flush xong sau {WRITER_JOIN_S}s")
+    await _HTTPX.aclose()
+
+def _fingerprint(items: list, meta: dict) -> int:
+    addr = meta.get("address") or {}
+    return hash((
+        tuple((p.get("item_id"), p.get("model_id"), p.get("amount"), p.get("order_price")) for p in items),
+        addr.get("shipping_name"), addr.get("shipping_phone"), addr.get("shipping_address"),
+        (meta.get("status") or {}).get("desc"),
+    ))
+
+def cache_store_from_order(order: dict, now: int | None = None):
     items = order.get("product_info") or []
     if not items: return
+    now = now or int(time())
     meta = {"address": order.get("address") or {}}
-    entry = {"items": items, "meta": meta, "ts": int(time())}
-    oid = order.get("order_id"); tn = order.get("tracking_number")
-    # RAM
-    if oid: PRODUCT_CACHE[oid] = entry
-    if tn:  PRODUCT_CACHE[tn]  = entry
-    # DB
-    if oid: db_upsert(oid, items, entry["ts"], meta)
-    if tn:  db_upsert(tn, items, entry["ts"], meta)
-
-def cache_get_all(key: str):
+    # Trạng thái lúc lấy từ Shopee: /list dùng khi không gọi được SPX
+    if order.get("tracking_info_description"):
+        meta["status"] = {"desc": order["tracking_info_description"], "ts": now}
+    entry = _Entry(items, meta, now, _fingerprint(items, meta))
+    # Mã vận đơn giả ("Đang chờ") nhiều đơn dùng chung => không làm key cache
+    tn = order.get("tracking_number")
+    keys = tuple(k for k in (order.get("order_id"), tn if tn not in TN_PLACEHOLDERS else None) if k)
+    if not keys: return
+    olds = [_ram_get(k, now) for k in keys]
+    if all(e and e.fp == entry.fp for e in olds):
+        for e in olds: e.ts = now  # dữ liệu không đổi: bỏ qua encode + ghi lại blob
+        _write_q.put((keys, None, None, now))            # nhưng vẫn làm mới ts trong DB, không thì purge xoá mất row
+        return
+    for k in keys: _ram_set(k, entry)                    # RAM
+    _write_q.put((keys, items, meta, now))               # DB (nền): 1 payload cho cả oid lẫn tn
+
+# RAM trên event loop; miss thì đọc DB trong executor (to_thread) để không chặn update khác
+async def cache_get_all(key: str, now: int | None = None):
     if not key: return {"items": None, "meta": None}
-    e = PRODUCT_CACHE.get(key)
-    if e and int(time()) - int(e["ts"]) <= CACHE_TTL:
-        return {"items": e.get("items"), "meta": e.get("meta")}
-    items, meta = db_get(key)
+    now = now or int(time())
+    e = _ram_get(key, now)
+    if e:
+        return {"items": e.items, "meta": e.meta}
+    items, meta = await asyncio.to_thread(db_get, key)
     if items:
-        PRODUCT_CACHE[key] = {"items": items, "meta": meta or {}, "ts": int(time())}
+        _ram_set(key, _Entry(items, meta or {}, now))
     return {"items": items, "meta": meta}
 
-def cache_get(key: str):
-    return cache_get_all(key).get("items")
+async def cache_get(key: str, now: int | None = None):
+    """Chỉ lấy items: RAM trước, miss thì đọc DB không decode meta."""
+    if not key: return None
+    now = now or int(time())
+    e = _ram_get(key, now)
+    if e:
+        return e.items
+    items, _ = await asyncio.to_thread(db_get_items, key)
+    return items
 
 # ===== Commands =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -99,26 +297,29 @@ async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Mua thành công! Số dư đã trừ.", reply_markup=build_menu())
 
 # ===== Shopee API =====
-def call_shopee_api(cookie_str: str) -> dict:
-    if not (cookie_str.startswith('SPC') or ';' in cookie_str or '=' in cookie_str):
+async def call_shopee_api(cookie_str: str) -> dict:
+    if not _COOKIE_RE.search(cookie_str):
         return {'error': 'Cookie không hợp lệ (phải chứa SPC, ; hoặc =).'}
+    if len(cookie_str) > COOKIE_MAX_LEN or _CTRL_RE.search(cookie_str):
+        return {'error': 'Cookie không hợp lệ (quá dài hoặc chứa ký tự lạ).'}
     payload = {"cookies": [cookie_str.strip()]}
     try:
-        r = requests.post(API_URL, json=payload, headers={'Content-Type':'application/json'}, timeout=10)
-        logger.info(f"Shopee status={r.status_code} body[:200]={r.text[:200]}...")
+        r = await _HTTPX.post(API_URL, json=payload)
+        logger.info(f"Shopee status={r.status_code} body[:200]={_body_head(r)}...")
         if r.status_code != 200:
-            return {'error': f'Status {r.status_code}: {r.text[:200]}'}
-        data = r.json()
+            return {'error': f'Status {r.status_code}: {_body_head(r)}'}
+        data = _loads(r.content)
         if 'allOrderDetails' not in data:
             return {'error': "Thiếu 'allOrderDetails' trong response."}
         return data
-    except requests.RequestException as e:
-        return {'error': str(e)}
+    except httpx.HTTPError as e:
+        return {'error': str(e) or type(e).__name__}
     except ValueError:
         return {'error': 'Response không phải JSON'}
 
 def parse_orders_from_api(data: dict) -> list:
     res = []
+    now = int(time())
     for order in data.get('allOrderDetails', []):
         if order.get('data') and order['data'].get('error') == 'DeadCookie':
             res.append({'noOrder': True})
@@ -127,24 +328,52 @@ def parse_orders_from_api(data: dict) -> list:
             od_copy = od.copy()
             od_copy['cookie'] = order.get('cookie')
             res.append(od_copy)
-            try: cache_store_from_order(od_copy)
+            try: cache_store_from_order(od_copy, now)
             except Exception as err: logger.warning(f"cache error: {err}")
     return res
 
 # ===== SPX API =====
-def call_spx_api(tn: str) -> dict:
+_SIMD = threading.local()  # simdjson.Parser không dùng chung giữa các thread được
+
+def _parse_spx(content: bytes) -> dict:
+    """Decode response SPX; có simdjson thì chỉ lấy retcode/message/data.sls_tracking_info."""
+    if simdjson is None:
+        return _loads(content)
+    parser = getattr(_SIMD, "parser", None)
+    if parser is None:
+        parser = _SIMD.parser = simdjson.Parser()
+    doc = parser.parse(content)
+    if not isinstance(doc, simdjson.Object):
+        return doc.as_list() if isinstance(doc, simdjson.Array) else doc
+    out = {"retcode": doc.get("retcode"), "message": doc.get("message"), "data": {}}
     try:
-        r = requests.get(SPX_API_URL, params={"spx_tn": tn, "language_code": "vi"}, timeout=10)
-        logger.info(f"SPX status={r.status_code} body[:200]={r.text[:200]}...")
-        if r.status_code != 200: return {"error": f"SPX status {r.status_code}: {r.text[:120]}"}
-        data = r.json()
+        info = doc.at_pointer("/data/sls_tracking_info")
+        out["data"]["sls_tracking_info"] = info.as_dict() if isinstance(info, simdjson.Object) else info
+    except (LookupError, TypeError):
+        pass
+    return out
+
+async def call_spx_api(tn: str, store_status: bool = True) -> dict:
+    try:
+        for i in range(SPX_RETRIES + 1):
+            r = await _HTTPX.get(SPX_API_URL, params={"spx_tn": tn, "language_code": "vi"})
+            if r.status_code not in SPX_RETRY_STATUS or i == SPX_RETRIES: break
+            await asyncio.sleep(SPX_BACKOFF_S * 2 ** i)  # gateway lỗi tạm thời -> chờ 0.3s, 0.6s rồi thử lại
+        logger.info(f"SPX status={r.status_code} body[:200]={_body_head(r)}...")
+        if r.status_code != 200: return {"error": f"SPX status {r.status_code}: {_body_head(r, 120)}"}
+        data = _parse_spx(r.content)
+        if not isinstance(data, dict): return {"error": "Response SPX không đúng định dạng"}
         if data.get("retcode") != 0: return {"error": f"SPX retcode {data.get('retcode')}: {data.get('message')}"}
+        if store_status: _spx_status_store(tn, data)
         return data
-    except requests.RequestException as e:
-        return {"error": str(e)}
+    except httpx.HTTPError as e:
+        return {"error": str(e) or type(e).__name__}
     except ValueError:
         return {"error": "Response SPX không phải JSON"}
 
+def _rec_time(r: dict) -> int:
+    return r.get("actual_time") or 0  # null -> 0, tránh so sánh None khi sort
+
 def format_spx_timeline(spx_json: dict) -> str:
     try:
         info = spx_json["data"]["sls_tracking_info"]
@@ -154,176 +383,209 @@ def format_spx_timeline(spx_json: dict) -> str:
     except Exception:
         return "❌ Không đọc được dữ liệu SPX."
 
-    recs_sorted = sorted(recs, key=lambda r: r.get("actual_time", 0), reverse=True)
+    recs_sorted = heapq.nlargest(8, recs, key=_rec_time)
     lines = [f"📦 **SPX: {tn}**" + (f"\n🆔 Đơn hàng: {client_order_id}" if client_order_id else "")]
-    for r in recs_sorted[:8]:
-        when = ts_to_vn(r.get("actual_time", 0))
+    for r in recs_sorted:
+        when = ts_to_vn(_rec_time(r))
         desc = (r.get("buyer_description") or r.get("description") or "").strip()
         loc = (r.get("current_location") or {}).get("location_name") or ""
         lines.append(f"• {when}\n  {desc}" + (f" — _{loc}_" if loc else ""))
     if not recs_sorted: lines.append("Không có cập nhật trạng thái.")
     return "\n".join(lines)
 
-def get_latest_spx_status(spx_code: str) -> tuple[str, str]:
-    data = call_spx_api(spx_code)
-    if "error" in data: return ("—", "")
+# Cache ngắn hạn trạng thái SPX: spx_tn -> (ts, (desc, when)); /list gọi dồn dập cùng mã.
+# Được điền ở mọi lần call_spx_api thành công (kể cả tra mã lẻ trong handle_input_text)
+_SPX_STATUS_CACHE: OrderedDict[str, tuple[float, tuple[str, str]]] = OrderedDict()
+SPX_STATUS_TTL, SPX_STATUS_MAX = 45, 2048
+
+def _spx_status_store(spx_code: str, data: dict) -> tuple[str, str] | None:
+    """Lưu (desc, time) mới nhất vào cache và trả về; None nếu response không có sls_tracking_info."""
     try:
         recs = data["data"]["sls_tracking_info"].get("records") or []
-        if not recs: return ("—", "")
-        last = max(recs, key=lambda r: r.get("actual_time", 0))
-        desc = (last.get("buyer_description") or last.get("description") or "").strip() or "—"
-        when = ts_to_vn(last.get("actual_time", 0))
-        return (desc, when)
     except Exception:
-        return ("—", "")
-
-# ===== Text handler =====
-async def handle_input_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (update.message.text or "").strip()
-
-    # 1) SPX code
-    spx_match = re.search(r"\bSPXVN[A-Z0-9]{8,}\b", text, re.IGNORECASE)
-    if spx_match:
-        spx_tn = spx_match.group(0).upper()
-        await update.message.reply_text(f"🔎 Đang tra SPX: {spx_tn} ...")
-        spx_data = call_spx_api(spx_tn)
-        if "error" in spx_data:
-            await update.message.reply_text(f"❌ Lỗi SPX: {spx_data['error']}", reply_markup=build_menu()); return
-
-        timeline = format_spx_timeline(spx_data)
-
-        # map sang sản phẩm + nơi nhận
-        info = spx_data.get("data", {}).get("sls_tracking_info", {})
-        client_order_id = info.get("client_order_id") or ""
-        sls_tn = info.get("sls_tn") or ""
-
-        cached = {"items": None, "meta": None}
-        for key in (client_order_id, sls_tn, spx_tn):
-            if key:
-                cached = cache_get_all(key)
-                if cached.get("items"): break
+        return None
+    if recs:
+        last = max(recs, key=_rec_time)
+        desc = (last.get("buyer_description") or last.get("description") or "").strip() or "—"
+        res = (desc, ts_to_vn(_rec_time(last)))
+    else:
+        res = ("—", "")
+    _SPX_STATUS_CACHE[spx_code] = (time(), res)
+    _SPX_STATUS_CACHE.move_to_end(spx_code)
+    while len(_SPX_STATUS_CACHE) > SPX_STATUS_MAX:
+        _SPX_STATUS_CACHE.popitem(last=False)
+    return res
 
-        items = cached.get("items") or []
-        meta = cached.get("meta") or {}
-        addr = (meta.get("address") or {})
-        who = " • ".join([x for x in [addr.get("shipping_name") or "", addr.get("shipping_phone") or ""] if x])
-        where = short_addr(addr.get("shipping_address") or "")
+def _spx_status_cached(spx_code: str, now: float | None = None) -> tuple[str, str] | None:
+    e = _SPX_STATUS_CACHE.get(spx_code)
+    return e[1] if e and (now or time()) - e[0] < SPX_STATUS_TTL else None
 
-        if items:
-            lines = [timeline, "\n🛒 **SẢN PHẨM**"]
-            for i, p in enumerate(items[:3], 1):
-                name = p.get("name") or "N/A"
-                model = p.get("model_name") or "—"
-                amount = p.get("amount", 1) or 1
-                raw = p.get("order_price", 0)
-                if isinstance(raw, (int, float)):
-                    unit = raw//100_000 if raw>1_000_000_000 else (raw//100 if raw>10_000 else raw)
-                else:
-                    unit = 0
-                price_txt = f"{amount}×{vnd(unit)}" if unit else f"x{amount}"
-                lines.append(f"{i}. {name} ({model}) — {price_txt}")
-            if who or where:
-                lines += ["\n📍 **NƠI NHẬN**", who if who else "", where if where else ""]
-            await update.message.reply_text("\n".join([x for x in lines if x]), reply_markup=build_menu())
-        else:
-            await update.message.reply_text(
-                f"{timeline}\n\nℹ️ Chưa có sản phẩm/nơi nhận cho mã này.\n"
-                "👉 Gửi cookie Shopee (SPC...) của đơn tương ứng để mình lưu, lần sau tra SPX sẽ hiện đầy đủ.",
-                reply_markup=build_menu()
-            )
-        return
+async def get_latest_spx_status(spx_code: str) -> tuple[str, str]:
+    cached = _spx_status_cached(spx_code)
+    if cached: return cached
 
-    # 2) Cookie Shopee
-    if ';' in text or text.startswith('SPC'):
-        await update.message.reply_text("🔄 Đang gọi API Shopee...")
-        data = call_shopee_api(text)
-        if 'error' in data:
-            await update.message.reply_text(f"❌ Lỗi API: {data['error']}", reply_markup=build_menu()); return
-        orders = parse_orders_from_api(data)
-        if not orders:
-            await update.message.reply_text("Không có order details từ API. Thử cookie khác!", reply_markup=build_menu()); return
-
-        od = orders[0]
-        if od.get("tracking_number") == "Đang chờ":
-            await update.message.reply_text("❌ Tài khoản đã bị cấm hoặc cookie hết hạn.", reply_markup=build_menu()); return
-        if od.get("noOrder"):
-            await update.message.reply_text("❌ DeadCookie - Cookie hết hạn.", reply_markup=build_menu()); return
-
-        try: db_purge_expired()
-        except Exception as err: logger.warning(f"purge error: {err}")
+    data = await call_spx_api(spx_code, store_status=False)
+    if "error" in data: return ("—", "")
+    # Không đọc lại cache: response thiếu sls_tracking_info thì entry cũ (đã quá TTL) vẫn nằm đó
+    return _spx_status_store(spx_code, data) or ("—", "")
 
-        # Render gọn kết quả chính
-        lines = []
-        status = od.get('tracking_info_description', 'Đơn hàng đang trong quá trình vận chuyển')
-        order_id = od.get('order_id', 'N/A')
-        order_time = od.get('order_time') or "—"
-        lines += [f"Tình trạng: {status}", f"Mã đơn hàng: {order_id}", f"Thời gian đặt hàng: {order_time}\n"]
-
-        addr = od.get('address', {}) or {}
-        name = addr.get('shipping_name', 'N/A')
-        phone = addr.get('shipping_phone', 'N/A')
-        if isinstance(phone, str) and phone.startswith('84') and len(phone) > 2: phone = f"(+84) {phone[2:]}"
-        address = addr.get('shipping_address', 'N/A')
-        lines += ["📦 ĐỊA CHỈ NHẬN HÀNG", name, phone, address, ""]
-
-        p = (od.get('product_info') or [{}])[0]
-        pname = p.get('name', 'N/A'); model = p.get('model_name', 'N/A')
-        item_id = p.get('item_id', ''); shop_id = p.get('shop_id', '')
-        link = f"https://shopee.vn/product/{shop_id}/{item_id}" if item_id and shop_id else 'N/A'
-        lines += ["🛍 SẢN PHẨM 1", f"Tên sản phẩm: {pname}", f"Phân loại: {model}", f"Liên kết: {link}", ""]
-
-        carrier = "SPX Express" if (od.get('tracking_number') or "").startswith('SPXVN') else 'N/A'
-        ship_method = od.get('shipping_method') or "Nhanh (Thanh toán khi nhận hàng)"
-        tracking = od.get('tracking_number', 'N/A')
-        lines += ["🚚 ĐƠN VỊ VẬN CHUYỂN", ship_method, f"Đơn vị vận chuyển: {carrier}", f"Mã vận đơn: {tracking}", f"Thông tin: {status}", ""]
-
-        amount = p.get('amount', 1) or 1
-        raw = p.get('order_price', 0)
-        if isinstance(raw, (int, float)):
-            unit = raw//100_000 if raw>1_000_000_000 else (raw//100 if raw>10_000 else raw)
-        else:
-            unit = 0
-        total = int(unit) * amount
-        lines.append(f"💵 Vui lòng thanh toán {vnd(total)} khi nhận hàng")
-        lines.append("\nGửi cookie khác hoặc nhập mã SPX để kiểm tra!")
-
-        await update.message.reply_text("\n".join(lines), reply_markup=build_menu())
-        return
+# ===== Text handler =====
+# Định tuyến bằng filters.Regex của PTB (bot_main): mỗi tin nhắn chỉ match 1 lần rồi vào thẳng handler
+# 1) SPX code: MessageHandler(filters.Regex(_SPX_RE)) => context.match là match của _SPX_RE
+async def handle_spx_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    spx_tn = context.match.group(0).upper()
+    await update.message.reply_text(f"🔎 Đang tra SPX: {spx_tn} ...")
+    spx_data = await call_spx_api(spx_tn)
+    if "error" in spx_data:
+        await update.message.reply_text(f"❌ Lỗi SPX: {spx_data['error']}", reply_markup=build_menu()); return
+
+    timeline = format_spx_timeline(spx_data)
+
+    # map sang sản phẩm + nơi nhận
+    info = spx_data.get("data", {}).get("sls_tracking_info", {})
+    client_order_id = info.get("client_order_id") or ""
+    sls_tn = info.get("sls_tn") or ""
+
+    cached = {"items": None, "meta": None}
+    for key in (client_order_id, sls_tn, spx_tn):
+        if key:
+            cached = await cache_get_all(key)
+            if cached.get("items"): break
+
+    items = cached.get("items") or []
+    meta = cached.get("meta") or {}
+    addr = (meta.get("address") or {})
+    who = " • ".join([x for x in [addr.get("shipping_name") or "", addr.get("shipping_phone") or ""] if x])
+    where = short_addr(addr.get("shipping_address") or "")
 
-    # 3) fallback
+    if items:
+        lines = [timeline, "\n🛒 **SẢN PHẨM**"]
+        for i, p in enumerate(items[:3], 1):
+            name = p.get("name") or "N/A"
+            model = p.get("model_name") or "—"
+            amount = p.get("amount", 1) or 1
+            unit = _normalize_price(p.get("order_price", 0))
+            price_txt = f"{amount}×{vnd(unit)}" if unit else f"x{amount}"
+            lines.append(f"{i}. {name} ({model}) — {price_txt}")
+        if who or where:
+            lines += ["\n📍 **NƠI NHẬN**", who if who else "", where if where else ""]
+        await update.message.reply_text("\n".join([x for x in lines if x]), reply_markup=build_menu())
+    else:
+        await update.message.reply_text(
+            f"{timeline}\n\nℹ️ Chưa có sản phẩm/nơi nhận cho mã này.\n"
+            "👉 Gửi cookie Shopee (SPC...) của đơn tương ứng để mình lưu, lần sau tra SPX sẽ hiện đầy đủ.",
+            reply_markup=build_menu()
+        )
+
+# 2) Cookie Shopee: MessageHandler(filters.Regex(_COOKIE_ROUTE_RE))
+async def handle_cookie_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = (update.message.text or "").strip()
+    await update.message.reply_text("🔄 Đang gọi API Shopee...")
+    data = await call_shopee_api(text)
+    if 'error' in data:
+        await update.message.reply_text(f"❌ Lỗi API: {data['error']}", reply_markup=build_menu()); return
+    orders = parse_orders_from_api(data)
+    if not orders:
+        await update.message.reply_text("Không có order details từ API. Thử cookie khác!", reply_markup=build_menu()); return
+
+    od = orders[0]
+    if od.get("tracking_number") in TN_PLACEHOLDERS:
+        await update.message.reply_text("❌ Tài khoản đã bị cấm hoặc cookie hết hạn.", reply_markup=build_menu()); return
+    if od.get("noOrder"):
+        await update.message.reply_text("❌ DeadCookie - Cookie hết hạn.", reply_markup=build_menu()); return
+
+    # Render gọn kết quả chính
+    lines = []
+    status = od.get('tracking_info_description', 'Đơn hàng đang trong quá trình vận chuyển')
+    order_id = od.get('order_id', 'N/A')
+    order_time = od.get('order_time') or "—"
+    lines += [f"Tình trạng: {status}", f"Mã đơn hàng: {order_id}", f"Thời gian đặt hàng: {order_time}\n"]
+
+    addr = od.get('address', {}) or {}
+    name = addr.get('shipping_name', 'N/A')
+    phone = addr.get('shipping_phone', 'N/A')
+    if isinstance(phone, str) and phone.startswith('84') and len(phone) > 2: phone = f"(+84) {phone[2:]}"
+    address = addr.get('shipping_address', 'N/A')
+    lines += ["📦 ĐỊA CHỈ NHẬN HÀNG", name, phone, address, ""]
+
+    p = (od.get('product_info') or [{}])[0]
+    pname = p.get('name', 'N/A'); model = p.get('model_name', 'N/A')
+    item_id = p.get('item_id', ''); shop_id = p.get('shop_id', '')
+    link = f"https://shopee.vn/product/{shop_id}/{item_id}" if item_id and shop_id else 'N/A'
+    lines += ["🛍 SẢN PHẨM 1", f"Tên sản phẩm: {pname}", f"Phân loại: {model}", f"Liên kết: {link}", ""]
+
+    carrier = "SPX Express" if (od.get('tracking_number') or "").startswith('SPXVN') else 'N/A'
+    ship_method = od.get('shipping_method') or "Nhanh (Thanh toán khi nhận hàng)"
+    tracking = od.get('tracking_number', 'N/A')
+    lines += ["🚚 ĐƠN VỊ VẬN CHUYỂN", ship_method, f"Đơn vị vận chuyển: {carrier}", f"Mã vận đơn: {tracking}", f"Thông tin: {status}", ""]
+
+    amount = p.get('amount', 1) or 1
+    unit = _normalize_price(p.get('order_price', 0))
+    total = unit * amount
+    lines.append(f"💵 Vui lòng thanh toán {vnd(total)} khi nhận hàng")
+    lines.append("\nGửi cookie khác hoặc nhập mã SPX để kiểm tra!")
+
+    await update.message.reply_text("\n".join(lines), reply_markup=build_menu())
+
+# 3) fallback: text còn lại (không phải lệnh, không match 2 route trên)
+async def handle_input_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Vui lòng gửi cookie Shopee hoặc mã SPX (SPXVN...)", reply_markup=build_menu())
 
 # ===== /list =====
 async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    spx_keys = db_list_spx_keys(limit=50)
-    if not spx_keys:
-        cutoff = int(time()) - CACHE_TTL
-        spx_keys = [k for k, v in PRODUCT_CACHE.items() if k.startswith("SPXVN") and int(v.get("ts",0)) >= cutoff][:50]
+    now = int(time())
+    # [(spx, first_name, meta, ts)] từ 1 SELECT; first_name lưu sẵn lúc ghi nên không cần decode items
+    rows = await asyncio.to_thread(db_list_spx_with_summary, 50)
+    if not rows:
+        cutoff = now - CACHE_TTL
+        rows = [
+            (k, (v.items or [{}])[0].get("name"), v.meta or {}, v.ts)
+            for k, v in reversed(PRODUCT_CACHE.items()) if k.startswith("SPXVN") and v.ts >= cutoff
+        ][:50]
+    spx_keys = [r[0] for r in rows]
     if not spx_keys:
         await update.message.reply_text("Chưa có SPX nào trong cache. Gửi cookie Shopee trước, rồi tra SPX.", reply_markup=build_menu()); return
 
-    lines, max_rows = ["📋 **Danh sách SPX gần đây** (tối đa 50)\n"], 20
+    # Chia trang theo ngân sách ký tự ngay lúc build (mỗi trang ≤ LIST_PAGE_CHARS), không cắt đuôi sau khi join
+    max_rows = 20
+    header = "📋 **Danh sách SPX gần đây** (tối đa 50)"
+    pages, page, size = [], [header], len(header)
+    def _add(block: str):
+        nonlocal page, size
+        if size + 2 + len(block) > LIST_PAGE_CHARS:
+            pages.append(page); page, size = [], -2
+        page.append(block); size += 2 + len(block)
+
+    # Mã còn trong cache trạng thái lấy ngay; chỉ mã miss mới gọi SPX, song song (HTTP/2 dồn chung 1 kết nối)
+    t = time()
+    statuses = [_spx_status_cached(spx, t) for spx in spx_keys[:max_rows]]
+    miss = [i for i, st in enumerate(statuses) if st is None]
+    if miss:
+        res = await asyncio.gather(*(get_latest_spx_status(spx_keys[i]) for i in miss), return_exceptions=True)
+        for i, st in zip(miss, res):
+            statuses[i] = ("—", "") if isinstance(st, BaseException) else st  # 1 mã lỗi không làm hỏng cả /list
     for idx, spx in enumerate(spx_keys):
         if idx >= max_rows:
-            lines.append(f"\n… và {len(spx_keys) - max_rows} mã khác"); break
+            _add(f"… và {len(spx_keys) - max_rows} mã khác"); break
 
-        cached = cache_get_all(spx)
-        items = cached.get("items") or []
-        meta = cached.get("meta") or {}
+        _, name, meta, _ = rows[idx]
         addr = meta.get("address") or {}
-        name = (items[0].get("name") or "N/A").strip() if items else "N/A"
+        name = (name or "N/A").strip()
         who = " • ".join([x for x in [addr.get("shipping_name") or "", addr.get("shipping_phone") or ""] if x])
         where = short_addr(addr.get("shipping_address") or "")
 
-        status, when = get_latest_spx_status(spx)
+        status, when = statuses[idx]
+        if status == "—" and meta.get("status"):  # SPX lỗi/chưa có: dùng trạng thái lưu từ Shopee
+            status = meta["status"].get("desc") or "—"
+            when = ts_to_vn(meta["status"]["ts"]) if meta["status"].get("ts") else ""
         when_txt = f" — {when}" if when else ""
 
-        lines += [f"• {spx}", f"  🛒 {name}", f"  🟢 {status}{when_txt}"]
-        if who or where:
-            lines.append(f"  📍 {who}".rstrip())
-            if where: lines.append(f"     {where}")
-        lines.append("")
+        who_line = f"  📍 {who}".rstrip() if who or where else ""
+        where_line = f"     {where}" if where else ""
+        # 1 block / mã
+        _add("\n".join(x for x in (f"• {spx}", f"  🛒 {name}", f"  🟢 {status}{when_txt}", who_line, where_line) if x))
+    pages.append(page)
 
-    out = "\n".join(lines)
-    if len(out) > 3800: out = out[:3800] + "\n…(đã rút gọn)"
-    await update.message.reply_text(out, reply_markup=build_menu())
+    # Gửi tuần tự để Telegram giữ đúng thứ tự trang; menu chỉ gắn ở trang cuối
+    for i, pg in enumerate(pages):
+        await update.message.reply_text("\n\n".join(pg), reply_markup=build_menu() if i == len(pages) - 1 else None)